@@ -0,0 +1,19 @@
+# init_db.py
+# One-shot schema bootstrap. Runs once per deploy (Procfile release phase) instead of on every web worker start.
+import asyncio
+import os
+
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from database import Base
+import models  # noqa: F401 -- importing registers the tables on Base.metadata
+
+
+async def create_schema():
+    engine = create_async_engine(os.environ["DATABASE_URL"].replace("postgresql://", "postgresql+asyncpg://"))
+    async with engine.begin() as conn: await conn.run_sync(Base.metadata.create_all)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(create_schema())
@@ -1,34 +1,43 @@
 import os
+import asyncio
 import logging
 import html
-import random
-import string
+import base64
 import re
+from collections import OrderedDict
 from contextlib import asynccontextmanager
+from decimal import Decimal
 
 from fastapi import FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse
 import uvicorn
-import json
+import orjson
+from aiolimiter import AsyncLimiter
 
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, selectinload
+from sqlalchemy import bindparam, func, update as sql_update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.future import select
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ChatType
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
+    Defaults,
     CommandHandler,
     ContextTypes,
     ConversationHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     filters,
 )
 
 # --- Import our model and base ---
 from database import Base
-from models import User, Transaction
+from models import User, Transaction, TxStatus
 
 # --- Basic Setup ---
 logging.basicConfig(
@@ -41,91 +50,203 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
 PUBLIC_URL = os.getenv("PUBLIC_URL")
 ADMIN_DEPOSIT_GROUP_ID = os.getenv("ADMIN_DEPOSIT_GROUP_ID")
+ENV = os.getenv("ENV", "production")
 
-if not DATABASE_URL or not TELEGRAM_BOT_TOKEN or not PUBLIC_URL:
+if not DATABASE_URL or not TELEGRAM_BOT_TOKEN or not PUBLIC_URL or not ADMIN_DEPOSIT_GROUP_ID:
     raise ValueError("One or more critical environment variables are not set!")
+ADMIN_DEPOSIT_GROUP_ID = int(ADMIN_DEPOSIT_GROUP_ID)
 
 
 # --- Conversation States ---
 ASKING_ID, ASKING_AMOUNT, ASKING_SCREENSHOT = range(3)
 
+# --- Messages ---
+BANK_DETAILS_MSG = "Please transfer to:\n\nBank: KBZ Bank\nAccount Name: U Aung\nAccount Number: 9988776655\n\nThen send a screenshot."
+
+# reason code -> (label shown to admins and the user, prompt for the corrected value, state that collects it)
+RESUBMIT_REASONS = {
+    "wrong_id": ("Wrong 1xBet ID", "Please enter your correct 1xBet ID:", ASKING_ID),
+    "wrong_amount": ("Wrong Amount", "Please enter the correct deposit amount:", ASKING_AMOUNT),
+    "wrong_slip": ("Wrong/Unclear Screenshot", "Please send a clear screenshot of your transaction:", ASKING_SCREENSHOT),
+}
+
+# Transaction.amount is NUMERIC(15,2), which leaves 13 digits before the decimal point
+AMOUNT_MAX_DIGITS = 13
+
+# Telegram's 1280px rendition keeps a receipt legible without forwarding the full-resolution original
+RECEIPT_PHOTO_MIN_SIDE = 1280
+
+# --- Message Filters ---
+PRIVATE_TEXT = filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE
+PRIVATE_PHOTO = filters.PHOTO & filters.ChatType.PRIVATE
+
+
+# --- Keyboards ---
+# Static markups are built once; per-request ones only format the callback_data.
+START_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("💰 Deposit", callback_data="deposit_start")]])
+NEW_REQUEST_BUTTONS_TEMPLATE = (("🔒 Lock & Take", "lock_req:{}"),)
+LOCKED_BUTTONS_TEMPLATE = (("✅ Approve", "approve_req:{}"), ("❌ Reject", "reject_req:{}"))
+REJECT_OPTIONS_TEMPLATE = (("Wrong ID", "resubmit:wrong_id:{}"), ("Wrong Amount", "resubmit:wrong_amount:{}"), ("Wrong Slip", "resubmit:wrong_slip:{}"))
+RESUBMIT_START_TEMPLATE = (("🔄 Resubmit", "resubmit_start:{}"),)
+
+
+# --- Statements ---
+# Built once at import; handlers only bind parameters, so SQLAlchemy reuses the compiled SQL from its cache.
+STMT_REGISTER_USER = (
+    pg_insert(User)
+    .values(user_id=bindparam("uid"), telegram_username=bindparam("uname"))
+    .on_conflict_do_nothing(index_elements=[User.user_id])
+)
+STMT_RESUBMIT_TX = (
+    sql_update(Transaction)
+    .where(Transaction.request_id == bindparam("rid"), Transaction.user_id == bindparam("uid"), Transaction.status == TxStatus.REJECTED)
+    .values(
+        status=TxStatus.PENDING,
+        xbet_id_from_user=func.coalesce(bindparam("new_xbet_id"), Transaction.xbet_id_from_user),
+        amount=func.coalesce(bindparam("new_amount", type_=Transaction.amount.type), Transaction.amount),
+        photo_file_id=func.coalesce(bindparam("new_photo_id"), Transaction.photo_file_id),
+        admin_chat_id=bindparam("chat"),
+        admin_message_id=bindparam("msg"),
+    )
+    .returning(Transaction.request_id)
+)
+STMT_LOCK_TX = (
+    sql_update(Transaction)
+    .where(Transaction.request_id == bindparam("rid"), Transaction.status == TxStatus.PENDING)
+    .values(status=TxStatus.LOCKED, admin_id=bindparam("aid"))
+    .returning(Transaction.request_id)
+)
+STMT_APPROVE_TX = (
+    sql_update(Transaction)
+    .where(Transaction.request_id == bindparam("rid"), Transaction.status == TxStatus.LOCKED, Transaction.admin_id == bindparam("aid"))
+    .values(status=TxStatus.APPROVED)
+    .returning(Transaction.user_id)
+)
+STMT_REJECT_TX = (
+    sql_update(Transaction)
+    .where(Transaction.request_id == bindparam("rid"), Transaction.status == TxStatus.LOCKED, Transaction.admin_id == bindparam("aid"))
+    .values(status=TxStatus.REJECTED)
+    .returning(Transaction.user_id)
+)
+STMT_TX_EXISTS = select(Transaction.transaction_id).where(Transaction.request_id == bindparam("rid"))
+STMT_TX_LOCKED_BY = select(Transaction.request_id).where(
+    Transaction.request_id == bindparam("rid"), Transaction.status == TxStatus.LOCKED, Transaction.admin_id == bindparam("aid")
+)
+STMT_TX_REJECTED_FOR_USER = select(Transaction.xbet_id_from_user, Transaction.amount).where(
+    Transaction.request_id == bindparam("rid"), Transaction.user_id == bindparam("uid"), Transaction.status == TxStatus.REJECTED
+)
+
 
 # --- Utility Functions ---
+STATUS_SUFFIX_RE = re.compile(r'\n\n---\n.*', re.DOTALL)
+
 def generate_request_id(prefix='DEP-', length=6):
-    return prefix + ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
+    # 5 random bytes -> 8 base32 chars (A-Z, 2-7); one C-level call instead of a Python loop
+    return prefix + base64.b32encode(os.urandom(5)).decode('ascii')[:length]
+
+def build_row_markup(template, request_id):
+    return InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data=data.format(request_id)) for text, data in template]])
+
+def build_column_markup(template, request_id):
+    return InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data=data.format(request_id))] for text, data in template])
+
+
+# --- Admin Group Notifications ---
+# Handlers enqueue the approve/reject status edits and return; one background task sends them,
+# so webhook latency no longer includes Telegram's. Deposit posts and lock/reject button swaps are
+# sent inline instead (the post's message id is stored with the row; the pressing admin waits on the
+# swap), but every admin-group call goes through the same 30 msg/s limiter.
+ADMIN_NOTIFY_INTERVAL = 0.1
+ADMIN_NOTIFY_BATCH = 30
+
+def notify_admins(context: ContextTypes.DEFAULT_TYPE, method: str, **kwargs) -> None:
+    context.bot_data["admin_queue"].put_nowait((method, kwargs))
+
+async def admin_notifier(queue: asyncio.Queue, bot, limiter: AsyncLimiter, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        try: await asyncio.wait_for(stop.wait(), ADMIN_NOTIFY_INTERVAL)
+        except asyncio.TimeoutError: pass
+        # Once stop is set, flush everything still queued so no status edit is lost on shutdown
+        for _ in range(queue.qsize() if stop.is_set() else min(queue.qsize(), ADMIN_NOTIFY_BATCH)):
+            method, kwargs = queue.get_nowait()
+            try:
+                async with limiter:
+                    await getattr(bot, method)(chat_id=ADMIN_DEPOSIT_GROUP_ID, **kwargs)
+            except Exception as e:
+                logger.error(f"Error in admin_notifier ({method}): {e}")
 
 
 # --- THIS IS THE NEW, CORRECTED FINALIZER FUNCTION ---
 async def finalize_submission(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = update.effective_user
-    photo_id = context.user_data.get('photo_id')
-    xbet_id = context.user_data.get('xbet_id')
-    amount = context.user_data.get('amount')
+    user = update.effective_user; user_data = context.user_data
+    photo_id = user_data.get('photo_id')
+    xbet_id = user_data.get('xbet_id')
+    amount = user_data.get('amount')
+    is_resubmission = user_data.get('mode') == 'update'
     
-    async with context.bot_data["db_session_factory"]() as session:
-        try:
-            if context.user_data.get('mode') == 'update':
-                # Handle resubmission
-                original_request_id = context.user_data.get('original_request_id')
-                result = await session.execute(
-                    select(Transaction).filter_by(request_id=original_request_id)
-                )
-                transaction = result.scalar_one_or_none()
-                if transaction:
-                    transaction.status = "PENDING"
-                    transaction.xbet_id_from_user = xbet_id or transaction.xbet_id_from_user
-                    transaction.amount = amount or transaction.amount
-                    transaction.photo_id = photo_id or transaction.photo_id
-                    transaction.updated_at = datetime.utcnow()
-            else:
-                # Handle new submission
-                transaction = Transaction(
-                    request_id=generate_request_id(),
-                    user_id=user.id,
-                    xbet_id_from_user=xbet_id,
-                    amount=amount,
-                    photo_id=photo_id,
-                    status="PENDING"
-                )
-                session.add(transaction)
-            
-            await session.commit()
-            await session.refresh(transaction)
-
-            # Send to admin group
-            keyboard = [
-                [
-                    InlineKeyboardButton("🔒 Lock", callback_data=f"lock:{transaction.request_id}"),
-                    InlineKeyboardButton("✅ Approve", callback_data=f"approve:{transaction.request_id}"),
-                    InlineKeyboardButton("❌ Reject", callback_data=f"reject:{transaction.request_id}")
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await context.bot.send_photo(
+    request_id = user_data.get('original_request_id') if is_resubmission else generate_request_id()
+    admin_message = None
+
+    try:
+        # Post to the admin group first so the row is written once, already knowing where the post landed.
+        # If the post fails nothing has been written; if the write fails the post is deleted. Either way the user is told to try again.
+        async with context.bot_data["admin_limiter"]:
+            admin_message = await context.bot.send_photo(
                 chat_id=ADMIN_DEPOSIT_GROUP_ID,
                 photo=photo_id,
-                caption=f"{'🔄 Resubmitted' if context.user_data.get('mode') == 'update' else '🆕 New'} Deposit Request\n"
-                       f"Request ID: {transaction.request_id}\n"
+                caption=f"{'🔄 Resubmitted' if is_resubmission else '🆕 New'} Deposit Request\n"
+                       f"Request ID: {request_id}\n"
                        f"User: {user.full_name}\n"
                        f"1xBet ID: {xbet_id}\n"
                        f"Amount: {amount}",
-                reply_markup=reply_markup
+                reply_markup=build_row_markup(NEW_REQUEST_BUTTONS_TEMPLATE, request_id)
             )
 
-            await update.message.reply_text(
-                "Your deposit request has been submitted. Please wait for confirmation."
-            )
-            
-            context.user_data.clear()
-            return ConversationHandler.END
-
-        except Exception as e:
-            logger.error(f"Error in finalize_submission: {e}")
-            await update.message.reply_text(
-                "Sorry, there was an error processing your request. Please try again."
-            )
-            return ConversationHandler.END
+        # Hold a pooled connection only for the DB work; the Telegram call above is already done.
+        async with context.bot_data["db_session_factory"].begin() as session:
+            if is_resubmission:
+                # Only the fields the user re-sent are overwritten; the rest keep their stored values
+                result = await session.execute(STMT_RESUBMIT_TX, {
+                    "rid": request_id, "uid": user.id, "new_xbet_id": xbet_id, "new_amount": amount, "new_photo_id": photo_id,
+                    "chat": admin_message.chat_id, "msg": admin_message.message_id,
+                })
+                result.scalar_one()
+            else:
+                session.add(Transaction(
+                    request_id=request_id,
+                    user_id=user.id,
+                    type="deposit",
+                    xbet_id_from_user=xbet_id,
+                    amount=amount,
+                    photo_file_id=photo_id,
+                    status=TxStatus.PENDING,
+                    admin_chat_id=admin_message.chat_id,
+                    admin_message_id=admin_message.message_id
+                ))
+
+    except Exception as e:
+        logger.error(f"Error in finalize_submission: {e}")
+        if admin_message is not None:
+            # The row was never written, so take the post down rather than leave admins a dead Lock button
+            try:
+                async with context.bot_data["admin_limiter"]:
+                    await context.bot.delete_message(admin_message.chat_id, admin_message.message_id)
+            except Exception as e:
+                logger.error(f"Error deleting orphaned admin post {admin_message.message_id}: {e}")
+        await update.message.reply_text(
+            "Sorry, there was an error processing your request. Please try again."
+        )
+        return ConversationHandler.END
+
+    # The row is committed; a failure from here on must not delete the post or invite a duplicate retry
+    user_data.clear()
+    try:
+        await update.message.reply_text(
+            "Your deposit request has been submitted. Please wait for confirmation."
+        )
+    except Exception as e:
+        logger.error(f"Error confirming submission {request_id}: {e}")
+    return ConversationHandler.END
 
 
 # --- All other handlers and setup code remain the same ---
@@ -133,14 +254,11 @@ async def finalize_submission(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
-    async with context.bot_data["db_session_factory"]() as session:
-        result = await session.execute(select(User).filter_by(user_id=user.id))
-        if not result.scalar_one_or_none():
-            session.add(User(user_id=user.id, telegram_username=user.username))
-            await session.commit()
-    keyboard = [[InlineKeyboardButton("💰 Deposit", callback_data="deposit_start")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_html(rf"Hello {user.mention_html()}! Please choose an option:", reply_markup=reply_markup)
+    async with context.bot_data["db_session_factory"].begin() as session:
+        # One round-trip: inserts first-time users, no-ops for known ones
+        result = await session.execute(STMT_REGISTER_USER, {"uid": user.id, "uname": user.username})
+    if result.rowcount == 1: logger.info(f"New user registered: {user.id}")
+    await update.message.reply_html(rf"Hello {user.mention_html()}! Please choose an option:", reply_markup=START_MARKUP)
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text("Operation cancelled."); context.user_data.clear(); return ConversationHandler.END
@@ -162,7 +280,15 @@ async def receive_xbet_id(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await update.message.reply_text("Thank you. Please enter the deposit amount."); return ASKING_AMOUNT
 
 async def receive_amount(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data['amount'] = update.message.text
+    # Validate and convert once here so a bad amount is caught before the screenshot step, not at INSERT time
+    text = update.message.text.strip().replace(',', '')
+    if not (text.isascii() and text.isdigit()):
+        await update.message.reply_text("Please enter the amount as a whole number, e.g. 50000."); return ASKING_AMOUNT
+    amount = Decimal(text)
+    # adjusted() is the exponent of the leading digit, so leading zeros don't count towards the limit
+    if not amount or amount.adjusted() >= AMOUNT_MAX_DIGITS:
+        await update.message.reply_text(f"Please enter an amount greater than 0 and at most {AMOUNT_MAX_DIGITS} digits long."); return ASKING_AMOUNT
+    context.user_data['amount'] = amount
     if context.user_data.get('mode') == 'update':
         # If the user was asked for a new slip, we already have their amount from the DB
         # We need the photo before we can finalize
@@ -170,143 +296,257 @@ async def receive_amount(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await update.message.reply_text("Amount has been updated. Please send the screenshot again to confirm.")
             return ASKING_SCREENSHOT
         return await finalize_submission(update, context)
-    bank_details = "Bank: KBZ Bank\nAccount Name: U Aung\nAccount Number: 9988776655"
-    await update.message.reply_text(f"Please transfer to:\n\n{bank_details}\n\nThen send a screenshot."); return ASKING_SCREENSHOT
+    await update.message.reply_text(BANK_DETAILS_MSG); return ASKING_SCREENSHOT
 
 async def receive_screenshot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not update.message.photo:
-        await update.message.reply_text("That is not a photo. Please send a screenshot."); return ASKING_SCREENSHOT
-    context.user_data['photo_id'] = update.message.photo[-1].file_id
+    message = update.message; photo = message.photo
+    if not photo:
+        await message.reply_text("That is not a photo. Please send a screenshot."); return ASKING_SCREENSHOT
+    # Smallest size whose longest side is >= RECEIPT_PHOTO_MIN_SIDE (sizes come smallest-first); fall back to the largest
+    context.user_data['photo_id'] = next(
+        (p.file_id for p in photo if max(p.width, p.height) >= RECEIPT_PHOTO_MIN_SIDE), photo[-1].file_id
+    )
     return await finalize_submission(update, context)
 
 async def lock_request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query; request_id = query.data.split(":")[1]; admin = query.from_user
-    async with context.bot_data["db_session_factory"]() as session:
-        result = await session.execute(select(Transaction).filter_by(request_id=request_id))
-        transaction = result.scalar_one_or_none()
-        if transaction and transaction.status == 'pending':
-            await query.answer("Request locked."); transaction.status = 'locked'; transaction.admin_id = admin.id; await session.commit()
-            keyboard = [[InlineKeyboardButton("✅ Approve", callback_data=f"approve_req:{request_id}"), InlineKeyboardButton("❌ Reject", callback_data=f"reject_req:{request_id}")]]; reply_markup = InlineKeyboardMarkup(keyboard)
-            new_caption = f"{query.message.caption_html}\n\n---\n<b>Status:</b> Locked by {admin.mention_html()}"
-            await query.edit_message_caption(caption=new_caption, parse_mode='HTML', reply_markup=reply_markup)
-        else: await query.answer("Already handled.", show_alert=True)
+    query = update.callback_query; request_id = context.matches[0].group("rid"); admin = query.from_user
+    # Single conditional UPDATE: the status check and the transition happen atomically, so two admins can't both lock.
+    async with context.bot_data["db_session_factory"].begin() as session:
+        result = await session.execute(STMT_LOCK_TX, {"rid": request_id, "aid": admin.id})
+        locked = result.first() is not None
+        # Only on a miss: tell a stale button apart from one another admin already took
+        exists = locked or (await session.execute(STMT_TX_EXISTS, {"rid": request_id})).first() is not None
+    if not locked:
+        await query.answer("Already handled." if exists else "Request not found.", show_alert=True); return
+    await query.answer("Request locked.")
+    # Only the buttons change on lock; the caption is rewritten once, when the request is approved or rejected
+    async with context.bot_data["admin_limiter"]:
+        await query.edit_message_reply_markup(reply_markup=build_row_markup(LOCKED_BUTTONS_TEMPLATE, request_id))
 
 async def approve_request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query; request_id = query.data.split(":")[1]; admin = query.from_user
-    async with context.bot_data["db_session_factory"]() as session:
-        result = await session.execute(select(Transaction).filter_by(request_id=request_id))
-        transaction = result.scalar_one_or_none()
-        if transaction and transaction.status == 'locked' and transaction.admin_id == admin.id:
-            await query.answer("Approved."); transaction.status = 'approved'; await session.commit()
-            await context.bot.send_message(chat_id=transaction.user_id, text=f"✅ Your deposit request (ID: {request_id}) approved.")
-            original_caption = re.sub(r'\n\n---\n.*', '', query.message.caption_html, flags=re.DOTALL)
-            new_caption = f"{original_caption}\n\n---\n<b>Status:</b> ✅ Approved by {admin.mention_html()}"
-            await query.edit_message_caption(caption=new_caption, parse_mode='HTML', reply_markup=None)
-        else: await query.answer("Cannot approve.", show_alert=True)
+    query = update.callback_query; request_id = context.matches[0].group("rid"); admin = query.from_user
+    async with context.bot_data["db_session_factory"].begin() as session:
+        result = await session.execute(STMT_APPROVE_TX, {"rid": request_id, "aid": admin.id})
+        row = result.first()
+    if row is None:
+        await query.answer("Cannot approve.", show_alert=True); return
+    await query.answer("Approved.")
+    await context.bot.send_message(chat_id=row.user_id, text=f"✅ Your deposit request (ID: {request_id}) approved.")
+    original_caption = STATUS_SUFFIX_RE.sub('', query.message.caption_html)
+    new_caption = f"{original_caption}\n\n---\n<b>Status:</b> ✅ Approved by {admin.mention_html()}"
+    notify_admins(
+        context, "edit_message_caption",
+        message_id=query.message.message_id,
+        caption=new_caption, parse_mode='HTML', reply_markup=None
+    )
 
 async def reject_request_options(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query; request_id = query.data.split(":")[1]; admin_id = query.from_user.id
+    query = update.callback_query; request_id = context.matches[0].group("rid"); admin_id = query.from_user.id
+    # Nothing changes yet, so only ask the DB whether this admin holds the lock.
     async with context.bot_data["db_session_factory"]() as session:
-        result = await session.execute(select(Transaction).filter_by(request_id=request_id))
-        transaction = result.scalar_one_or_none()
-        if not (transaction and transaction.status == 'locked' and transaction.admin_id == admin_id):
-            await query.answer("Cannot reject.", show_alert=True); return
+        holds_lock = (await session.execute(STMT_TX_LOCKED_BY, {"rid": request_id, "aid": admin_id})).first() is not None
+    if not holds_lock:
+        await query.answer("Cannot reject.", show_alert=True); return
     await query.answer()
-    keyboard = [[InlineKeyboardButton("Wrong ID", callback_data=f"resubmit:wrong_id:{request_id}")], [InlineKeyboardButton("Wrong Amount", callback_data=f"resubmit:wrong_amount:{request_id}")], [InlineKeyboardButton("Wrong Slip", callback_data=f"resubmit:wrong_slip:{request_id}")]]; reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_reply_markup(reply_markup=reply_markup)
+    reply_markup = build_column_markup(REJECT_OPTIONS_TEMPLATE, request_id)
+    async with context.bot_data["admin_limiter"]:
+        await query.edit_message_reply_markup(reply_markup=reply_markup)
 
-async def request_resubmission(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def request_resubmission(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    await query.answer()
-    _, reason_code, request_id = query.data.split(":")
+    reason_code, request_id = context.matches[0].group("reason", "rid")
     admin = query.from_user
-    reasons = {
-        "wrong_id": "Wrong 1xBet ID",
-        "wrong_amount": "Wrong Amount", 
-        "wrong_slip": "Wrong/Unclear Screenshot"
-    }
-    reason_text = reasons.get(reason_code, "Unknown")
+    reason_text = RESUBMIT_REASONS[reason_code][0]
+
+    async with context.bot_data["db_session_factory"].begin() as session:
+        # Mark rejected and fetch the depositor's chat id in one round-trip; only the admin holding the lock can reject
+        result = await session.execute(STMT_REJECT_TX, {"rid": request_id, "aid": admin.id})
+        row = result.first()
+        # Only on a miss: tell a stale button apart from one whose request is gone
+        exists = row is not None or (await session.execute(STMT_TX_EXISTS, {"rid": request_id})).first() is not None
+
+    # The connection is back in the pool; everything below is Telegram I/O only.
+    if row is None:
+        await query.answer("Cannot reject." if exists else "Request not found.", show_alert=True); return
+    await query.answer()
+
+    # Mark the admin post rejected; the post is a photo, so its caption is edited and the buttons removed
+    original_caption = STATUS_SUFFIX_RE.sub('', query.message.caption_html)
+    new_caption = f"{original_caption}\n\n---\n<b>Status:</b> 🚫 Rejected by {admin.mention_html()}\n<b>Reason:</b> {reason_text}"
+    notify_admins(
+        context, "edit_message_caption",
+        message_id=query.message.message_id,
+        caption=new_caption, parse_mode='HTML', reply_markup=None
+    )
 
+    # The resubmission flow runs in the depositor's own conversation: this handler's conversation key and
+    # user_data are the admin's, so the user starts the flow from the button in their private chat.
+    await context.bot.send_message(
+        chat_id=row.user_id,
+        text=f"Your deposit request (ID: {request_id}) was rejected.\nReason: {reason_text}\n\nTap below to resubmit it.",
+        reply_markup=build_row_markup(RESUBMIT_START_TEMPLATE, f"{reason_code}:{request_id}")
+    )
+
+async def resubmit_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query; await query.answer()
+    reason_code, request_id = context.matches[0].group("reason", "rid")
     async with context.bot_data["db_session_factory"]() as session:
-        # Get the transaction and user
-        result = await session.execute(
-            select(Transaction).filter_by(request_id=request_id)
-            .options(selectinload(Transaction.user))
-        )
-        transaction = result.scalar_one_or_none()
-        
-        if not transaction:
-            await query.edit_message_text("Error: Transaction not found")
-            return ConversationHandler.END
-
-        # Update transaction status
-        transaction.status = "REJECTED"
-        transaction.admin_id = admin.id
-        transaction.rejection_reason = reason_text
-        await session.commit()
-
-        # Setup resubmission context
-        context.user_data.clear()
-        context.user_data['mode'] = 'update'
-        context.user_data['original_request_id'] = request_id
-
-        # Notify admin group about rejection
-        admin_message = (
-            f"🚫 Request {request_id} REJECTED\n"
-            f"Reason: {reason_text}\n"
-            f"By admin: {admin.full_name}"
-        )
-        await context.bot.edit_message_text(
-            chat_id=ADMIN_DEPOSIT_GROUP_ID,
-            message_id=query.message.message_id,
-            text=admin_message
-        )
+        # Only the depositor can resubmit, and only while the request is still rejected
+        row = (await session.execute(STMT_TX_REJECTED_FOR_USER, {"rid": request_id, "uid": query.from_user.id})).first()
+    if row is None:
+        await query.edit_message_text("This request can no longer be resubmitted."); return ConversationHandler.END
+
+    # Start from the stored values so the resubmitted admin post shows the full request;
+    # the user then re-sends the rejected field (and the screenshot).
+    context.user_data.clear()
+    context.user_data['mode'] = 'update'
+    context.user_data['original_request_id'] = request_id
+    context.user_data['xbet_id'] = row.xbet_id_from_user
+    context.user_data['amount'] = row.amount
+
+    _, prompt, state = RESUBMIT_REASONS[reason_code]
+    await query.edit_message_text(f"{query.message.text}\n\n{prompt}")
+    return state
+
+# --- User Data Bounds ---
+# PTB keeps user_data and chat_data for every user and chat it has ever seen; keep only the most recently active users.
+USER_DATA_LIMIT = 10_000
+PTB_PENDING_DELETE_ATTRS = ("_user_ids_to_be_deleted_in_persistence", "_chat_ids_to_be_deleted_in_persistence")
+
+def evict_user(application: Application, user_id: int) -> None:
+    # A user's private chat has the same id as the user, so its chat_data goes too
+    application.drop_user_data(user_id); application.drop_chat_data(user_id)
+    # drop_*_data also queues the id for the next persistence flush; with no persistence that flush never
+    # happens and the queued ids would pile up, so take them back out.
+    if application.persistence is None:
+        for pending in PTB_PENDING_DELETE_ATTRS:
+            # Private PTB attributes (21.x); if an upgrade renames them, eviction still works and only the id set grows
+            ids = getattr(application, pending, None)
+            if isinstance(ids, set): ids.discard(user_id)
+
+async def track_user_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    if user is None: return
+    recent_users = context.bot_data["recent_users"]
+    recent_users[user.id] = None; recent_users.move_to_end(user.id)
+    while len(recent_users) > USER_DATA_LIMIT:
+        evict_user(context.application, recent_users.popitem(last=False)[0])
+
+async def expire_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Runs when a deposit flow hits conversation_timeout; drop the half-filled form
+    context.user_data.clear()
+
+# --- Admin Callback Dispatch ---
+# One regex test per admin button press instead of one per registered handler;
+# handlers read the request id from the match PTB already made (context.matches).
+ADMIN_CALLBACK_PATTERN = re.compile(r"^(?P<action>lock_req|approve_req|reject_req):(?P<rid>[A-Z0-9\-]+)$")
+RESUBMIT_CALLBACK_PATTERN = re.compile(r"^resubmit:(?P<reason>wrong_id|wrong_amount|wrong_slip):(?P<rid>[A-Z0-9\-]+)$")
+RESUBMIT_START_PATTERN = re.compile(r"^resubmit_start:(?P<reason>wrong_id|wrong_amount|wrong_slip):(?P<rid>[A-Z0-9\-]+)$")
+ADMIN_CALLBACK_DISPATCH = {
+    "lock_req": lock_request,
+    "approve_req": approve_request,
+    "reject_req": reject_request_options,
+}
+
+async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await ADMIN_CALLBACK_DISPATCH[context.matches[0].group("action")](update, context)
+
+# --- Update Processing ---
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    # Updates from different chats run concurrently; updates from the same private chat keep their arrival order.
+    # Other chats (the admin group) are not serialized: PTB takes a concurrency slot before do_process_update runs,
+    # so queueing every admin press behind one lock would hold slots other chats need. Admin actions are
+    # guarded by conditional UPDATEs instead.
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._chat_locks = {}  # chat_id -> [asyncio.Lock, number of updates holding or waiting on it]
+
+    async def do_process_update(self, update, coroutine) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None or chat.type != ChatType.PRIVATE:
+            await coroutine; return
+        chat_id = chat.id
+        entry = self._chat_locks.get(chat_id)
+        if entry is None: entry = self._chat_locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]: await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]: del self._chat_locks[chat_id]
+
+    async def initialize(self) -> None: pass
+
+    async def shutdown(self) -> None: pass
 
-        # Message the user and start resubmission flow
-        user_message = f"Your deposit request was rejected.\nReason: {reason_text}\n\n"
-        if reason_code == "wrong_id":
-            user_message += "Please enter your correct 1xBet ID:"
-            await context.bot.send_message(chat_id=transaction.user.telegram_id, text=user_message)
-            return ASKING_ID
-        elif reason_code == "wrong_amount":
-            user_message += "Please enter the correct deposit amount:"
-            await context.bot.send_message(chat_id=transaction.user.telegram_id, text=user_message)
-            return ASKING_AMOUNT
-        else:  # wrong_slip
-            user_message += "Please send a clear screenshot of your transaction:"
-            await context.bot.send_message(chat_id=transaction.user.telegram_id, text=user_message)
-            return ASKING_SCREENSHOT
 # --- FastAPI & Application Setup ---
+DB_POOL_SIZE = 20
+
+async def warm_db_connection(engine) -> None:
+    async with engine.connect() as conn: await conn.exec_driver_sql("SELECT 1")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     ASYNC_DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://")
-    engine = create_async_engine(ASYNC_DATABASE_URL)
-    async with engine.begin() as conn: await conn.run_sync(Base.metadata.create_all)
-    db_session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
-    ptb_app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-    ptb_app.bot_data["db_session_factory"] = db_session_factory
+    engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        pool_size=DB_POOL_SIZE, max_overflow=40, pool_timeout=30, query_cache_size=1200,
+        pool_recycle=3600, pool_pre_ping=True,  # drop connections Postgres has idled out before a handler gets one
+        pool_use_lifo=True,  # reuse the most recently returned connection so a small hot set stays warm
+        connect_args={
+            "server_settings": {"application_name": "gg4nextwin", "jit": "off"}, "command_timeout": 60,
+            # SQLAlchemy's per-connection cache of asyncpg prepared statements (default 100), so repeat lookups skip the server-side parse
+            "prepared_statement_cache_size": 500,
+        },
+    )
+    # Production schema is created by init_db.py in the release phase; only local dev bootstraps it here
+    if ENV == "dev":
+        async with engine.begin() as conn: await conn.run_sync(Base.metadata.create_all)
+    # Open the whole pool up front (concurrently) so the first burst of updates doesn't pay connect latency
+    await asyncio.gather(*(warm_db_connection(engine) for _ in range(DB_POOL_SIZE)))
+    db_session_factory = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    # One pooled keep-alive client for all Bot API calls so TLS setup is amortized across the admin workflow.
+    # Updates arrive via webhook, so no separate get_updates_request is needed.
+    # HTTP/2 multiplexes concurrent calls over the same connection and compresses repeated headers.
+    bot_request = HTTPXRequest(connection_pool_size=64, pool_timeout=10.0, http_version="2", connect_timeout=5.0, read_timeout=20.0, write_timeout=20.0)
+    # All replies go to private chats, which never quote; saying so up front skips PTB's per-reply quote resolution.
+    ptb_app = Application.builder().token(TELEGRAM_BOT_TOKEN).request(bot_request).defaults(Defaults(do_quote=False)).concurrent_updates(PerChatUpdateProcessor(64)).build()
+    ptb_app.bot_data["db_session_factory"] = db_session_factory; ptb_app.bot_data["recent_users"] = OrderedDict()
+    admin_queue = asyncio.Queue(); ptb_app.bot_data["admin_queue"] = admin_queue
+    admin_limiter = AsyncLimiter(30, 1); ptb_app.bot_data["admin_limiter"] = admin_limiter  # shared by every admin-group send
     deposit_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(deposit_start, pattern="^deposit_start$"), CallbackQueryHandler(request_resubmission, pattern=r"^resubmit:")],
+        entry_points=[CallbackQueryHandler(deposit_start, pattern="^deposit_start$"), CallbackQueryHandler(resubmit_start, pattern=RESUBMIT_START_PATTERN)],
         states={
-            ASKING_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, receive_xbet_id)],
-            ASKING_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, receive_amount)],
-            ASKING_SCREENSHOT: [MessageHandler(filters.PHOTO & filters.ChatType.PRIVATE, receive_screenshot)],
+            ASKING_ID: [MessageHandler(PRIVATE_TEXT, receive_xbet_id)],
+            ASKING_AMOUNT: [MessageHandler(PRIVATE_TEXT, receive_amount)],
+            ASKING_SCREENSHOT: [MessageHandler(PRIVATE_PHOTO, receive_screenshot)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, expire_conversation)],
         },
         fallbacks=[CommandHandler("cancel", cancel)], per_message=False, conversation_timeout=600
     )
+    ptb_app.add_handler(TypeHandler(Update, track_user_data), group=-1)
     ptb_app.add_handler(CommandHandler("start", start, filters=filters.ChatType.PRIVATE))
     ptb_app.add_handler(deposit_conv_handler)
-    ptb_app.add_handler(CallbackQueryHandler(lock_request, pattern=r"^lock_req:"))
-    ptb_app.add_handler(CallbackQueryHandler(approve_request, pattern=r"^approve_req:"))
-    ptb_app.add_handler(CallbackQueryHandler(reject_request_options, pattern=r"^reject_req:"))
+    ptb_app.add_handler(CallbackQueryHandler(admin_callback, pattern=ADMIN_CALLBACK_PATTERN))
+    ptb_app.add_handler(CallbackQueryHandler(request_resubmission, pattern=RESUBMIT_CALLBACK_PATTERN))
     app.state.ptb_app = ptb_app
     await ptb_app.initialize(); webhook_url = f"https://{PUBLIC_URL}/webhook"; await ptb_app.bot.set_webhook(url=webhook_url, allowed_updates=Update.ALL_TYPES); await ptb_app.start()
+    notifier_stop = asyncio.Event()
+    notifier_task = asyncio.create_task(admin_notifier(admin_queue, ptb_app.bot, admin_limiter, notifier_stop))
     yield
-    await ptb_app.stop(); await ptb_app.shutdown()
+    # Stop PTB first so no handler enqueues after the flush, then let the notifier send what is left
+    await ptb_app.stop(); notifier_stop.set(); await notifier_task; await ptb_app.shutdown()
 
-app = FastAPI(lifespan=lifespan)
+HEALTH_RESPONSE_BODY = b'{"status":"ok","message":"Full resubmission workflow active."}'
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 @app.post("/webhook")
 async def process_telegram_update(request: Request):
-    ptb_app = request.app.state.ptb_app; update = Update.de_json(await request.json(), ptb_app.bot); await ptb_app.process_update(update); return Response(status_code=200)
+    # Ack immediately; PTB's update fetcher drains the queue and PerChatUpdateProcessor orders updates per chat.
+    ptb_app = request.app.state.ptb_app; ptb_app.update_queue.put_nowait(Update.de_json(orjson.loads(await request.body()), ptb_app.bot)); return Response(status_code=200)
 @app.get("/")
-async def health_check(): return {"status": "ok", "message": "Full resubmission workflow active."}
\ No newline at end of file
+async def health_check(): return Response(content=HEALTH_RESPONSE_BODY, media_type="application/json")
+
+if __name__ == "__main__":
+    # loop="auto" runs on uvloop when it is installed and falls back to asyncio (e.g. on Windows)
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "8000")), loop="auto")
\ No newline at end of file
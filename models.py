@@ -1,8 +1,15 @@
 # models.py
-from sqlalchemy import Column, BigInteger, String, Numeric, TIMESTAMP, text, ForeignKey, Integer, Text
+import enum
+from sqlalchemy import Column, BigInteger, String, Numeric, TIMESTAMP, text, ForeignKey, Integer, Text, Enum, Index
 from sqlalchemy.orm import relationship
 from database import Base
 
+class TxStatus(str, enum.Enum):
+    PENDING = 'pending'
+    LOCKED = 'locked'
+    APPROVED = 'approved'
+    REJECTED = 'rejected'
+
 class User(Base):
     __tablename__ = "users"
     user_id = Column(BigInteger, primary_key=True)
@@ -10,16 +17,23 @@ class User(Base):
     rank = Column(String(50), nullable=False, server_default='Bronze')
     cumulative_deposit = Column(Numeric(15, 2), nullable=False, server_default=text('0.00'))
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
-    transactions = relationship("Transaction", back_populates="user")
+    # lazy="raise": an implicit lazy load would be blocking IO inside the event loop; use selectinload() explicitly
+    transactions = relationship("Transaction", back_populates="user", lazy="raise")
 
 class Transaction(Base):
     __tablename__ = "transactions"
+    __table_args__ = (
+        # Per-user history in date order; also indexes the user_id foreign key, which Postgres doesn't do on its own
+        Index('ix_tx_user_created', 'user_id', 'created_at'),
+    )
     transaction_id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(BigInteger, ForeignKey('users.user_id'), nullable=False)
     request_id = Column(String(20), nullable=False, unique=True)
     type = Column(String(50), nullable=False)
     amount = Column(Numeric(15, 2), nullable=False)
-    status = Column(String(50), nullable=False, server_default='pending')
+    # Non-native enum: stored in the existing VARCHAR(50) column as the lowercase values
+    status = Column(Enum(TxStatus, name="tx_status", native_enum=False, length=50, values_callable=lambda e: [m.value for m in e]),
+                    nullable=False, server_default=TxStatus.PENDING.value)
     admin_id = Column(BigInteger, nullable=True)
     admin_chat_id = Column(BigInteger, nullable=True)
     admin_message_id = Column(Integer, nullable=True)
@@ -29,5 +43,5 @@ class Transaction(Base):
     photo_file_id = Column(String(255), nullable=True)
     
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
-    updated_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
-    user = relationship("User", back_populates="transactions")
\ No newline at end of file
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'), onupdate=text('now()'))
+    user = relationship("User", back_populates="transactions", lazy="raise")
\ No newline at end of file